@@ -1,15 +1,30 @@
 import os
 import io
-import re
 import json
+import time
+import hashlib
+import itertools
+import multiprocessing
+import threading
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import httplib2
 import streamlit as st
-import PyPDF2
-from docx import Document
+import diskcache
+import faiss
+import numpy as np
+from lxml import etree
 from huggingface_hub import InferenceClient
+from sentence_transformers import SentenceTransformer
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import DEFAULT_CHUNK_SIZE, MediaIoBaseDownload
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
+import pdf_text
 
 # -------------------- CONFIG --------------------
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
@@ -19,6 +34,11 @@ client_id = st.secrets["google_oauth"]["client_id"]
 client_secret = st.secrets["google_oauth"]["client_secret"]
 redirect_uri = st.secrets["google_oauth"]["redirect_uri"]
 
+# Optional self-hosted TGI/vLLM endpoint. Serve it with prefix caching enabled
+# (TGI >= 3 does this by default, vLLM needs --enable-prefix-caching) so
+# repeated document context is not prefilled again on every question.
+LLM_ENDPOINT = st.secrets.get("LLM_ENDPOINT")
+
 # Allowed file types
 ALLOWED_MIMES = [
     "application/pdf",
@@ -29,9 +49,51 @@ ALLOWED_MIMES = [
     "application/vnd.google-apps.spreadsheet",
 ]
 
+# Drive query keywords: stopwords dropped, at most MAX_KEYWORDS kept
+STOPWORDS = frozenset({
+    "the", "a", "an", "of", "and", "or", "to", "is", "in", "for", "on", "with",
+    "what", "how", "why",
+})
+MAX_KEYWORDS = 8
+
+# Parallel Drive downloads, on a pool shared by all sessions
+MAX_DOWNLOAD_WORKERS = 8
+HTTP_TIMEOUT = 30  # seconds
+SERVICES_PER_THREAD = 4  # recently used users' Drive connections kept per pool thread
+
+# All PDF parsing runs on one process pool; PDFs longer than PARALLEL_PDF_MIN_PAGES
+# have their remaining pages split into ranges of at least PDF_PAGES_PER_TASK.
+# Each spawned worker also imports app.py (torch, faiss, ...), so the pool stays
+# small and is sized from the CPUs this process may use, not the host's.
+PDF_WORKERS = min(
+    4, len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+)
+PARALLEL_PDF_MIN_PAGES = 40
+PDF_PAGES_PER_TASK = 10
+PDF_TASK_TIMEOUT = 60  # seconds per page-range task
+
+# Extracted text kept per file for indexing
+MAX_FILE_CHARS = 200_000
+
+# Chunk index: files are chunked and embedded once, chunks retrieved per question.
+# all-MiniLM-L6-v2 truncates input at 256 word pieces, so chunks stay near 200 words.
+INDEX_DIR = "./.drive_index"
+CHUNK_WORDS = 200
+CHUNK_OVERLAP_WORDS = 20
+TOP_K_CHUNKS = 8
+# The index is shared by every session and keeps chunk text in plain form, so
+# files are evicted oldest-first past a count and once they were indexed too long ago
+INDEX_MAX_FILES = 500
+INDEX_MAX_AGE = 7 * 24 * 3600  # seconds
+
+# Near-duplicate questions reuse an earlier answer from the same session
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_TTL = 15 * 60  # seconds
+
 # -------------------- AUTH --------------------
 def authenticate_drive():
-    """OAuth authentication flow for Streamlit Cloud"""
+    """OAuth authentication flow for Streamlit Cloud; returns (creds, drive_service)"""
     creds = None
 
     if "credentials" in st.session_state:
@@ -56,7 +118,7 @@ def authenticate_drive():
         if "code" not in st.query_params:
             auth_url, _ = flow.authorization_url(prompt="consent")
             st.markdown(f"[🔐 Sign in with Google Drive]({auth_url})")
-            return None
+            return None, None
 
         else:
             code = st.query_params["code"]
@@ -64,28 +126,184 @@ def authenticate_drive():
             creds = flow.credentials
             st.session_state["credentials"] = json.loads(creds.to_json())
 
-    return build("drive", "v3", credentials=creds)
+    return get_drive_session(creds.to_json())
+
+def build_drive_service(creds):
+    """Drive service over its own keep-alive httplib2 connection (not thread-safe)"""
+    http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+    return build("drive", "v3", http=http, cache_discovery=False)
+
+@st.cache_resource(show_spinner=False, ttl=3600)
+def get_drive_session(creds_json: str):
+    """(creds, Drive service) per credential set, reused across Streamlit reruns"""
+    creds = Credentials.from_authorized_user_info(json.loads(creds_json), SCOPES)
+    return creds, build_drive_service(creds)
+
+def credentials_key(creds):
+    """Stable per-user key derived from the credentials, without a Drive call"""
+    return hashlib.sha256((creds.refresh_token or creds.token).encode()).hexdigest()
 
 # -------------------- HELPERS --------------------
+# Every byte except ASCII letters and digits becomes a space
+_ALNUM = frozenset(b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+_SANITIZE_TABLE = bytes(c if c in _ALNUM else 0x20 for c in range(256))
+
 def sanitize_for_drive(q: str) -> str:
-    q = q.replace("'", " ").replace('"', " ").replace("\\", " ")
-    q = re.sub(r"[^0-9A-Za-z\s]", " ", q)
-    q = re.sub(r"\s+", " ", q).strip()
-    return q
+    # Non-ASCII chars encode to "?" and are blanked with everything else in one pass
+    cleaned = q.encode("ascii", "replace").translate(_SANITIZE_TABLE).decode("ascii")
+    return " ".join(cleaned.split())
+
+def keywords_from_query(q: str, min_len: int = 2) -> list[str]:
+    """Lowercased, de-duplicated keywords in query order, stopwords dropped.
 
-def keywords_from_query(q: str, min_len: int = 2):
-    s = sanitize_for_drive(q)
-    return [t for t in s.split() if len(t) >= min_len]
+    Past MAX_KEYWORDS, the most repeated and then longest terms are kept.
+    """
+    s = sanitize_for_drive(q).lower()
+    kept = [t for t in s.split() if len(t) >= min_len and t not in STOPWORDS]
+    keywords = list(dict.fromkeys(kept))
+    if len(keywords) > MAX_KEYWORDS:
+        tf = Counter(kept)
+        # sorted() is stable, so ties keep query order
+        top = set(sorted(keywords, key=lambda k: (tf[k], len(k)), reverse=True)[:MAX_KEYWORDS])
+        keywords = [k for k in keywords if k in top]
+    return keywords
 
-def build_drive_q_for_keywords(keywords: list):
+def build_drive_q_for_keywords(keywords: list[str], phrase: str) -> str | None:
     if not keywords:
         return None
-    parts = [f"(name contains '{k}' or fullText contains '{k}')" for k in keywords]
-    keyword_filter = " or ".join(parts)
+    # One fullText clause for the whole phrase; per-keyword name matches are cheap
+    name_parts = [f"name contains '{k}'" for k in keywords]
+    keyword_filter = f"fullText contains '{phrase}' or {' or '.join(name_parts)}"
     mime_filter = " or ".join([f"mimeType='{m}'" for m in ALLOWED_MIMES])
     return f"({keyword_filter}) and ({mime_filter}) and trashed=false"
 
-def read_file(file_id, mime_type, drive_service):
+_thread_local = threading.local()
+
+def thread_drive_service(creds):
+    """Per-thread, per-user Drive service; pool threads keep their connections between questions"""
+    services = _thread_local.__dict__.setdefault("services", OrderedDict())
+    key = credentials_key(creds)
+    if key in services:
+        services.move_to_end(key)
+    else:
+        services[key] = build_drive_service(creds)
+        if len(services) > SERVICES_PER_THREAD:
+            _, evicted = services.popitem(last=False)
+            evicted.close()
+    return services[key]
+
+@st.cache_resource
+def get_download_executor():
+    return ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS, thread_name_prefix="drive-download")
+
+@st.cache_resource
+def get_pdf_executor():
+    # spawn, not fork: forking the multi-threaded Streamlit server is unsafe
+    return ProcessPoolExecutor(
+        max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+def join_until(texts, max_chars):
+    """Space-join texts, stopping as soon as max_chars have been collected"""
+    parts, total = [], 0
+    for text in texts:
+        parts.append(text)
+        total += len(text) + 1
+        if total > max_chars:
+            break
+    return " ".join(parts)
+
+def retire_pdf_executor(pool, terminate=False):
+    """Stop routing PDFs to pool; the next get_pdf_executor() call builds a fresh one"""
+    # Another thread may already have replaced it
+    if get_pdf_executor() is pool:
+        get_pdf_executor.clear()
+    # Python 3.14+ can kill a hung worker; older versions leave it to finish
+    if terminate and hasattr(pool, "terminate_workers"):
+        pool.terminate_workers()
+    else:
+        pool.shutdown(wait=False)
+
+def extract_pdf_text(data, max_chars):
+    """PyMuPDF is not thread-safe, so every call goes to the shared PDF process pool.
+
+    A worker that crashes (MuPDF segfault, OOM kill) breaks the whole pool, so
+    the pool is replaced and the document retried once. A document that hangs
+    past PDF_TASK_TIMEOUT fails on its own and its pool is retired.
+    """
+    for attempt in range(2):
+        pool = get_pdf_executor()
+        try:
+            return _extract_pdf_text(pool, data, max_chars)
+        except BrokenProcessPool:
+            retire_pdf_executor(pool)
+            if attempt:
+                raise
+        except FuturesTimeoutError:
+            retire_pdf_executor(pool, terminate=True)
+            raise
+
+def _extract_pdf_text(pool, data, max_chars):
+    # The first range also reports the page count; short PDFs end here
+    text, page_count = pool.submit(
+        pdf_text.extract_text, data, max_chars, 0, PARALLEL_PDF_MIN_PAGES
+    ).result(timeout=PDF_TASK_TIMEOUT)
+    if page_count <= PARALLEL_PDF_MIN_PAGES or len(text) >= max_chars:
+        return text
+
+    # At most PDF_WORKERS ranges; every task is sent its own copy of the bytes, and
+    # tasks are not pinned to workers, so keep the range count low rather than per page
+    remaining = page_count - PARALLEL_PDF_MIN_PAGES
+    per_task = max(PDF_PAGES_PER_TASK, -(-remaining // PDF_WORKERS))
+    futures = [
+        pool.submit(pdf_text.extract_text, data, max_chars, start, start + per_task)
+        for start in range(PARALLEL_PDF_MIN_PAGES, page_count, per_task)
+    ]
+    try:
+        results = (future.result(timeout=PDF_TASK_TIMEOUT)[0] for future in futures)
+        texts = itertools.chain([text], results)
+        return join_until((t for t in texts if t), max_chars)
+    finally:
+        # Ranges past the budget are never needed
+        for future in futures:
+            future.cancel()
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+OFFICE_DOCUMENT_REL = (
+    "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+)
+# Run-level breaks that python-docx's Paragraph.text turned into whitespace
+DOCX_BREAK_TAGS = frozenset({f"{W_NS}tab", f"{W_NS}br", f"{W_NS}cr"})
+
+def docx_main_part(z):
+    """Main document part named in _rels/.rels, as python-docx resolves it"""
+    with z.open("_rels/.rels") as rels:
+        root = etree.parse(rels, etree.XMLParser(resolve_entities=False)).getroot()
+    for rel in root.iter(f"{PKG_REL_NS}Relationship"):
+        if rel.get("Type") == OFFICE_DOCUMENT_REL:
+            return rel.get("Target").lstrip("/")
+    raise KeyError("no officeDocument relationship in _rels/.rels")
+
+def docx_paragraphs(fh):
+    """Paragraph text streamed from the main document part; runs are joined within a paragraph"""
+    with zipfile.ZipFile(fh) as z, z.open(docx_main_part(z)) as xml:
+        runs = []
+        tags = (f"{W_NS}t", f"{W_NS}p", *DOCX_BREAK_TAGS)
+        # Files can be shared by anyone, so entities are never expanded
+        for _, el in etree.iterparse(xml, tag=tags, resolve_entities=False):
+            if el.tag == f"{W_NS}t":
+                runs.append(el.text or "")
+            elif el.tag in DOCX_BREAK_TAGS:
+                # w:tab also defines tab stops under w:pPr; only run content counts
+                if el.getparent().tag == f"{W_NS}r":
+                    runs.append(" ")
+            else:
+                yield "".join(runs)
+                runs = []
+                el.clear()
+
+def read_file(file_id, mime_type, drive_service, max_chars=MAX_FILE_CHARS):
     fh = io.BytesIO()
     if mime_type.startswith("application/vnd.google-apps"):
         if mime_type == "application/vnd.google-apps.document":
@@ -97,90 +315,379 @@ def read_file(file_id, mime_type, drive_service):
     else:
         request = drive_service.files().get_media(fileId=file_id)
 
-    downloader = MediaIoBaseDownload(fh, request)
+    # Text formats can stop once the budget is covered (UTF-8 is at most 4 bytes
+    # per char); PDF and DOCX need the whole file to parse
+    partial = mime_type not in (
+        "application/pdf",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    )
+    max_bytes = max_chars * 4
+    downloader = MediaIoBaseDownload(
+        fh, request, chunksize=max_bytes if partial else DEFAULT_CHUNK_SIZE
+    )
     done = False
     while not done:
         _, done = downloader.next_chunk()
+        if partial and fh.tell() >= max_bytes:
+            break
     fh.seek(0)
 
     if mime_type == "application/pdf":
-        reader = PyPDF2.PdfReader(fh)
-        return " ".join([p.extract_text() for p in reader.pages if p.extract_text()])
+        return extract_pdf_text(fh.getvalue(), max_chars)
     elif mime_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-        doc = Document(fh)
-        return " ".join([p.text for p in doc.paragraphs])
+        return join_until(docx_paragraphs(fh), max_chars)
     else:
-        return fh.read().decode("utf-8", errors="ignore")
+        return fh.read().decode("utf-8", errors="ignore")[:max_chars]
+
+def read_file_threaded(file_id, mime_type, creds):
+    return read_file(file_id, mime_type, thread_drive_service(creds))
 
-def search_drive(query, drive_service, max_results=5):
+@st.cache_data(ttl=300, max_entries=128, show_spinner=False)
+def list_drive_files(q, max_results, user_key, _drive_service):
+    """files().list memoized per (q, user); the service itself is not hashed"""
+    res = _drive_service.files().list(
+        q=q,
+        pageSize=max_results,
+        fields="files(id, name, mimeType, size, modifiedTime)",
+        orderBy="modifiedTime desc",
+        # Search only the user's own Drive, not shared drives or the domain
+        corpora="user",
+        spaces="drive",
+        supportsAllDrives=False,
+        includeItemsFromAllDrives=False,
+    ).execute()
+    return res.get("files", []) or []
+
+def search_drive(query, drive_service, creds, max_results=5):
+    """Matching files, [] when nothing matches, or None when the Drive call failed"""
     keywords = keywords_from_query(query)
     if not keywords:
         return []
 
-    q = build_drive_q_for_keywords(keywords)
+    q = build_drive_q_for_keywords(keywords, " ".join(keywords))
     try:
-        res = drive_service.files().list(
-            q=q,
-            pageSize=max_results,
-            fields="files(id, name, mimeType, size, modifiedTime)",
-            orderBy="modifiedTime desc",
-        ).execute()
-        return res.get("files", []) or []
+        return list_drive_files(q, max_results, credentials_key(creds), drive_service)
     except Exception as e:
         st.error(f"Drive search error: {e}")
+        return None
+
+# -------------------- SEMANTIC CACHE --------------------
+@st.cache_resource
+def load_embedder():
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+def embed(texts):
+    """Unit-length float32 embeddings, so inner product is cosine similarity"""
+    return load_embedder().encode(texts, normalize_embeddings=True, convert_to_numpy=True)
+
+class SemanticCache:
+    """Answers looked up by cosine similarity of the question embedding"""
+
+    def __init__(self, dim, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL):
+        self.index = faiss.IndexFlatIP(dim)
+        self.entries = []  # (answer, created_at), row-aligned with the index
+        self.threshold = threshold
+        self.ttl = ttl
+
+    def _prune(self):
+        # Entries are appended in time order, so expired ones form a prefix
+        now = time.time()
+        expired = 0
+        while expired < len(self.entries) and now - self.entries[expired][1] > self.ttl:
+            expired += 1
+        if expired:
+            self.index.remove_ids(np.arange(expired, dtype=np.int64))
+            del self.entries[:expired]
+
+    def get(self, query_vec):
+        self._prune()
+        if self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search(query_vec, 1)
+        if scores[0][0] >= self.threshold:
+            return self.entries[ids[0][0]][0]
+        return None
+
+    def put(self, query_vec, answer):
+        self.index.add(query_vec)
+        self.entries.append((answer, time.time()))
+
+# -------------------- DOCUMENT INDEX --------------------
+def chunk_text(text, size=CHUNK_WORDS, overlap=CHUNK_OVERLAP_WORDS):
+    words = text.split()
+    if not words:
         return []
+    step = size - overlap
+    return [" ".join(words[i:i + size]) for i in range(0, max(len(words) - overlap, 1), step)]
+
+class DocumentIndex:
+    """Chunk embeddings for Drive files, persisted under INDEX_DIR.
+
+    Vectors are stored as 8-bit codes in a FAISS IndexIDMap2 keyed by chunk id.
+    Chunk text and each file's (modifiedTime, chunk ids, indexed_at) record
+    live in a diskcache alongside it. A file's record is held in memory until the
+    vectors it points to have been written, so the store never claims a file
+    is indexed when the index on disk does not have it.
+    """
+
+    def __init__(self, path=INDEX_DIR):
+        self.store = diskcache.Cache(path)
+        self.index_path = os.path.join(path, "chunks.faiss")
+        self.lock = threading.Lock()
+        self.pending = {}  # file_id -> record, not yet backed by the index on disk
+        self.indexed_at = {}  # file_id -> when it was indexed, pending or stored
+        self.save_queued = False
+        self.saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-save")
+        if os.path.exists(self.index_path):
+            self.index = faiss.read_index(self.index_path)
+        else:
+            dim = load_embedder().get_sentence_embedding_dimension()
+            vectors = faiss.IndexScalarQuantizer(
+                dim, faiss.ScalarQuantizer.QT_8bit_uniform, faiss.METRIC_INNER_PRODUCT
+            )
+            # Unit vectors keep every component in [-1, 1]; training on the two
+            # corners fixes that range without needing real data up front
+            vectors.train(np.array([[-1.0] * dim, [1.0] * dim], dtype=np.float32))
+            self.index = faiss.IndexIDMap2(vectors)
+        with self.lock:
+            changed = self._reconcile()
+            changed = self._evict() or changed
+        if changed:
+            self.schedule_save()
+
+    def _reconcile(self):
+        """Make the store and the loaded index agree after a crash or lost save.
+
+        Drops file records whose vectors never reached disk, chunk text no
+        record points to, and vectors no record points to. Returns whether the
+        in-memory index changed and needs saving.
+        """
+        on_disk = set(faiss.vector_to_array(self.index.id_map).tolist())
+        referenced, chunk_keys = set(), []
+        for key in list(self.store):
+            if not isinstance(key, tuple):
+                continue
+            if key[0] == "chunk":
+                chunk_keys.append(key)
+                continue
+            record = self.store.get(key)
+            if record is None:
+                continue
+            if not on_disk.issuperset(record[1]):
+                self.store.delete(key)
+                continue
+            referenced.update(record[1])
+            # Records written before indexed_at existed count as expired
+            self.indexed_at[key[1]] = record[2] if len(record) > 2 else 0
+        for key in chunk_keys:
+            if key[1] not in referenced:
+                self.store.delete(key)
+        orphans = on_disk - referenced
+        if orphans:
+            self.index.remove_ids(np.array(sorted(orphans), dtype=np.int64))
+        return bool(orphans)
+
+    def _record(self, file_id):
+        return self.pending.get(file_id) or self.store.get(("file", file_id))
+
+    def is_current(self, f):
+        with self.lock:
+            entry = self._record(f["id"])
+        return entry is not None and entry[0] == f.get("modifiedTime")
+
+    def add_file(self, f, text):
+        chunks = chunk_text(text)
+        vecs = embed(chunks) if chunks else None
+        with self.lock:
+            self._drop_file(f["id"])
+            start = self.store.get("next_id", 0)
+            ids = np.arange(start, start + len(chunks), dtype=np.int64)
+            if chunks:
+                self.index.add_with_ids(vecs, ids)
+            for chunk_id, chunk in zip(ids.tolist(), chunks):
+                self.store.set(("chunk", chunk_id), (f["id"], chunk))
+            self.store.set("next_id", start + len(chunks))
+            now = time.time()
+            self.pending[f["id"]] = (f.get("modifiedTime"), ids.tolist(), now)
+            self.indexed_at[f["id"]] = now
+            self._evict()
+
+    def _drop_file(self, file_id):
+        # A file's record is either pending or stored, never both
+        entry = self.pending.pop(file_id, None) or self.store.pop(("file", file_id), None)
+        self.indexed_at.pop(file_id, None)
+        if entry:
+            self.index.remove_ids(np.array(entry[1], dtype=np.int64))
+            for chunk_id in entry[1]:
+                self.store.delete(("chunk", chunk_id))
+
+    def _evict(self):
+        """Drop files past INDEX_MAX_FILES or INDEX_MAX_AGE, oldest first.
+
+        Only the in-memory index changes; the caller schedules a save.
+        """
+        cutoff = time.time() - INDEX_MAX_AGE
+        by_age = sorted(self.indexed_at.items(), key=lambda item: item[1])
+        excess = len(by_age) - INDEX_MAX_FILES
+        for n, (file_id, indexed_at) in enumerate(by_age):
+            if n >= excess and indexed_at >= cutoff:
+                return n
+            self._drop_file(file_id)
+        return len(by_age)
+
+    def schedule_save(self):
+        """Persist in the background; at most one save is queued at a time"""
+        with self.lock:
+            if self.save_queued:
+                return
+            self.save_queued = True
+        self.saver.submit(self._save)
+
+    def _save(self):
+        with self.lock:
+            self.save_queued = False
+            data = faiss.serialize_index(self.index)
+            written = dict(self.pending)
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(data.tobytes())
+        os.replace(tmp_path, self.index_path)
+
+        # Commit only records whose vectors were in the snapshot just written
+        with self.lock:
+            for file_id, record in written.items():
+                if self.pending.get(file_id) is record:
+                    self.store.set(("file", file_id), record)
+                    del self.pending[file_id]
+
+    def search(self, query_vec, file_ids, k=TOP_K_CHUNKS):
+        """Top-k (file_id, chunk) pairs, restricted to the given files.
+
+        The index is shared by all sessions; limiting the search to files the
+        user's own Drive search returned keeps other users' chunks out.
+        """
+        with self.lock:
+            chunk_ids = [
+                chunk_id
+                for file_id in file_ids
+                for chunk_id in (self._record(file_id) or (None, []))[1]
+            ]
+            if not chunk_ids:
+                return []
+            subset = np.array(chunk_ids, dtype=np.int64)
+            selector = faiss.IDSelectorBatch(len(subset), faiss.swig_ptr(subset))
+            _, ids = self.index.search(
+                query_vec, min(k, len(subset)), params=faiss.SearchParameters(sel=selector)
+            )
+            return [self.store[("chunk", chunk_id)] for chunk_id in ids[0].tolist() if chunk_id != -1]
+
+@st.cache_resource
+def get_document_index():
+    return DocumentIndex()
 
 # -------------------- CHATBOT AGENT --------------------
+@st.cache_resource(show_spinner=False)
+def get_inference_client(model):
+    return InferenceClient(model, token=HF_TOKEN)
+
 class DriveChatAgent:
-    def __init__(self, model="meta-llama/Meta-Llama-3-8B-Instruct"):
-        self.client = InferenceClient(model, token=HF_TOKEN)
+    def __init__(self, model="meta-llama/Meta-Llama-3-8B-Instruct", endpoint=LLM_ENDPOINT, cache=None):
+        self.client = get_inference_client(endpoint or model)
+        self.cache = cache
 
-    def answer_question(self, user_query, drive_service):
-        files = search_drive(user_query, drive_service)
+    def answer_question(self, user_query, drive_service, creds):
+        """Yields the answer as it is generated; the full text is cached at the end"""
+        query_vec = embed([user_query])
+        if self.cache is not None:
+            cached = self.cache.get(query_vec)
+            if cached is not None:
+                yield cached
+                return
+
+        files = search_drive(user_query, drive_service, creds)
 
         context = ""
         if files:
-            for f in files:
-                try:
-                    text = read_file(f["id"], f["mimeType"], drive_service)
-                    snippet = text[:5000]
-                    context += f"\n--- {f['name']} ---\n{snippet}"
-                except Exception as e:
-                    context += f"\n--- {f['name']} ---\n[Error: {e}]"
+            index = get_document_index()
+            errors = {}
+            stale = [f for f in files if not index.is_current(f)]
+            if stale:
+                ex = get_download_executor()
+                futures = {
+                    ex.submit(read_file_threaded, f["id"], f["mimeType"], creds): f
+                    for f in stale
+                }
+                for future in as_completed(futures):
+                    f = futures[future]
+                    try:
+                        index.add_file(f, future.result())
+                    except Exception as e:
+                        errors[f["id"]] = f"[Error: {e}]"
+                index.schedule_save()
+
+            names = {f["id"]: f["name"] for f in files}
+            hits = index.search(query_vec, [f["id"] for f in files if f["id"] not in errors])
+            sections = [f"\n--- {names[file_id]} ---\n{chunk}" for file_id, chunk in hits]
+            sections += [f"\n--- {names[file_id]} ---\n{error}" for file_id, error in errors.items()]
+            context = "".join(sections)
 
         system = (
             "You are an assistant that answers user questions using provided context from Google Drive. "
             "If the context is empty, use your own knowledge."
         )
 
+        # Context before the question keeps the shared prefix cacheable server-side
         user_text = f"Context:\n{context}\n\nQuestion: {user_query}"
 
-        response = self.client.chat_completion(
+        stream = self.client.chat_completion(
             messages=[
                 {"role": "system", "content": system},
                 {"role": "user", "content": user_text},
             ],
             max_tokens=500,
             temperature=0.2,
+            stream=True,
         )
 
-        return response.choices[0].message["content"].strip()
+        parts = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            parts.append(delta)
+            yield delta
+
+        # An answer given without Drive context because search failed is not reusable
+        if self.cache is not None and files is not None:
+            self.cache.put(query_vec, "".join(parts).strip())
 
 # -------------------- STREAMLIT UI --------------------
-st.title("📂 Google Drive + Hugging Face Chatbot")
-st.write("Ask a question and I will search your Google Drive for answers.")
+# Streamlit runs this script as __main__. Spawned PDF workers import it as
+# __mp_main__ and must not render the page or start the OAuth flow.
+if __name__ == "__main__":
+    st.title("📂 Google Drive + Hugging Face Chatbot")
+    st.write("Ask a question and I will search your Google Drive for answers.")
 
-drive_service = authenticate_drive()
+    creds, drive_service = authenticate_drive()
 
-if drive_service:
-    query = st.text_input("Enter your question:")
+    if drive_service:
+        query = st.text_input("Enter your question:")
 
-    if st.button("Search & Answer"):
-        if not query.strip():
-            st.warning("Please enter a question first.")
-        else:
-            agent = DriveChatAgent()
-            answer = agent.answer_question(query, drive_service)
+        if st.button("Refresh Drive results"):
+            # Drop memoized searches and answers built from them
+            list_drive_files.clear()
+            st.session_state.pop("semantic_cache", None)
+
+        if st.button("Search & Answer"):
+            if not query.strip():
+                st.warning("Please enter a question first.")
+            else:
+                # Kept per session: cached answers are built from this user's Drive
+                if "semantic_cache" not in st.session_state:
+                    dim = load_embedder().get_sentence_embedding_dimension()
+                    st.session_state["semantic_cache"] = SemanticCache(dim)
+                agent = DriveChatAgent(cache=st.session_state["semantic_cache"])
 
-            st.subheader("Answer:")
-            st.write(answer)
+                st.subheader("Answer:")
+                st.write_stream(agent.answer_question(query, drive_service, creds))
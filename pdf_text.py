@@ -0,0 +1,30 @@
+"""PDF text extraction, run only inside app.py's PDF worker processes.
+
+PyMuPDF is not thread-safe, so it is never called on Streamlit or download
+threads. Spawned workers still import app.py as __mp_main__ (Streamlit points
+__main__.__file__ at it), which is why its UI sits behind a __main__ guard. This
+module only keeps the worker function small and picklable by reference, with
+PyMuPDF as its one dependency.
+"""
+import pymupdf
+
+
+def extract_text(data, max_chars, start=0, stop=None):
+    """Text of pages [start, stop), stopping once max_chars are collected.
+
+    Returns (text, page_count) so the first call also tells the caller how
+    long the document is.
+    """
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        page_count = doc.page_count
+        stop = page_count if stop is None else min(stop, page_count)
+        parts, total = [], 0
+        for i in range(start, stop):
+            text = doc.load_page(i).get_text("text")
+            if not text:
+                continue
+            parts.append(text)
+            total += len(text) + 1
+            if total > max_chars:
+                break
+        return " ".join(parts), page_count